@@ -7,19 +7,129 @@ expected output.
 from __future__ import print_function
 
 import sys, os
-import glob
+import asyncio
 import difflib
+import re
+import functools
+import hashlib
+import io
+import json
+import mmap
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+import subprocess
 from subprocess import Popen, PIPE
 
 PROG = '../vt100.py'
 IN_EXT = '.in'
 FORMATS = ['text', 'html']
+MODES = ['asyncio', 'batch', 'inprocess', 'server', 'spawn']
+DIFF_WINDOW = 20        # lines of context around the first difference
+TEST_RE = re.compile(r't\d{4}-.*\.in\Z')
 
-def slurp(filename):
+sys.path.insert(0, os.path.dirname(PROG) or '..')
+import vt100
+
+CACHE_FILE = '.run_all.cache.json'
+
+# Filenames from a single os.scandir pass, so existence checks for every
+# (test, format) pair are set lookups instead of stat syscalls.
+_existing = None
+
+def scan_directory():
+    global _existing
+    _existing = set(e.name for e in os.scandir('.') if e.is_file())
+
+def exists(filename):
+    if _existing is None:
+        return os.path.exists(filename)
+    return filename in _existing
+
+# Pass/fail results from prior runs, keyed by content digests so a re-run
+# where nothing changed skips the parse entirely.  Invalidated wholesale
+# when vt100.py itself changes.
+_prog_digest = None
+_result_cache = {}
+
+# The digests only need to detect changed files, not resist an attacker;
+# use xxhash when installed since it is several times faster than sha256.
+try:
+    import xxhash
+    _new_hash = xxhash.xxh3_64
+    HASH_NAME = 'xxh3_64'
+except ImportError:
+    _new_hash = hashlib.sha256
+    HASH_NAME = 'sha256'
+
+def _hash_file(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return _new_hash(b'').hexdigest()
+        # mmap avoids a full read() copy on repeat hashing.
+        mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            return _new_hash(mm).hexdigest()
+        finally:
+            mm.close()
+
+def load_cache():
+    global _prog_digest, _result_cache
+    _prog_digest = _hash_file(PROG)
+    try:
+        with open(CACHE_FILE) as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return
+    if (data.get('hash') == HASH_NAME and
+            data.get('vt100') == _prog_digest):
+        _result_cache.update(data.get('results', {}))
+
+def save_cache():
+    tmp = CACHE_FILE + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'hash': HASH_NAME, 'vt100': _prog_digest,
+                   'results': _result_cache}, f)
+    os.replace(tmp, CACHE_FILE)
+
+def cache_key(test_name, fmt):
+    try:
+        return (_hash_file(test_name + IN_EXT) +
+                _hash_file('%s.%s' % (test_name, fmt)))
+    except OSError:
+        return None
+
+@functools.lru_cache(maxsize=None)
+def _slurp_cached(filename, mtime):
     with open(filename, 'rb') as f:
-        return f.read().decode('ascii')
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return b''
+        # Map the file instead of copying it into a fresh bytes object;
+        # the comparison works zero-copy through a memoryview.
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
 
-def compare_output(command, out_filename):
+def slurp(filename):
+    # Keyed on mtime so a regenerated expected file is re-read.
+    return _slurp_cached(filename, os.path.getmtime(filename))
+
+@functools.lru_cache(maxsize=None)
+def _expected_lines(filename, mtime):
+    """The expected file decoded and split once, for the failure path."""
+    expected = bytes(_slurp_cached(filename, mtime))
+    return tuple(expected.decode('ascii', 'replace').splitlines(keepends=True))
+
+def compare_text(output, out_filename, source):
+    """Compare `output` (bytes) against the expected file's contents.
+
+    The comparison stays on raw bytes; decoding only happens on the
+    failure path, to feed difflib.
+    """
     try:
         expected = slurp(out_filename)
     except IOError as e:
@@ -28,62 +138,371 @@ def compare_output(command, out_filename):
             return False
         else:
             raise
-    p = Popen(command, stdout=PIPE, stderr=PIPE)
-    output, stderr = p.communicate()
-    output = output.decode('ascii')
-    stderr = stderr.decode('utf-8')
-    if p.returncode != 0 or stderr:
-        print("program returned %d:" % p.returncode)
-        print('\x1b[33m%s\x1b[m' % stderr, end='')
-        return False
-    elif output == expected:
+    if memoryview(expected) == output:
         return True
     else:
-        lines = difflib.unified_diff(expected.split('\n'), output.split('\n'),
-                fromfile=out_filename, tofile=' '.join(command), lineterm='')
-        for line in lines:
-            if line[0] == '+':
-                print('\x1b[32m' + line[1:] + '\x1b[0m')
-            elif line[0] == '-':
-                print('\x1b[31m' + line[1:] + '\x1b[0m')
-            elif line[0] == '@':
-                print('\x1b[36m' + line + '\x1b[0m')
-            elif line[0] == ' ':
-                print(line[1:])
-            else:
-                print(line)
-        print('\n'.join(lines))
+        # SequenceMatcher is O(N*M); bound the diff to a window around the
+        # first differing line so huge failing outputs stay cheap to report.
+        # keepends=True spares unified_diff from re-appending newlines.
+        a = _expected_lines(out_filename, os.path.getmtime(out_filename))
+        b = output.decode('ascii', 'replace').splitlines(keepends=True)
+        i = next((k for k, (x, y) in enumerate(zip(a, b)) if x != y),
+                 min(len(a), len(b)))
+        start = max(0, i - DIFF_WINDOW)
+        lines = list(difflib.unified_diff(
+                a[start:i+DIFF_WINDOW], b[start:i+DIFF_WINDOW],
+                fromfile=out_filename, tofile=source, lineterm=''))
+        sys.stdout.writelines(_colorize(line) for line in lines)
+        return False
+
+# Diff-marker character -> (escape prefix, escape suffix, strip marker?).
+DIFF_STYLE = {
+        '+' : ('\x1b[32m', '\x1b[0m', 1),
+        '-' : ('\x1b[31m', '\x1b[0m', 1),
+        '@' : ('\x1b[36m', '\x1b[0m', 0),
+        ' ' : ('', '', 1),
+        }
+
+def _colorize(line):
+    start, end, strip = DIFF_STYLE.get(line[:1], ('', '', 0))
+    # Keep the escape-sequence reset before the newline.
+    text = line[strip:]
+    if text.endswith('\n'):
+        text = text[:-1]
+    return start + text + end + '\n'
+
+def vt100_command(*args):
+    """Build the command list to launch vt100.py.
+
+    $PYTHON overrides the interpreter (e.g. to test an optimized build);
+    with no override the script is exec'ed directly via its shebang when
+    possible, skipping one level of argument parsing.
+    """
+    python = os.environ.get('PYTHON')
+    if python:
+        return [python, PROG] + list(args)
+    if os.access(PROG, os.X_OK):
+        return [PROG] + list(args)
+    return [sys.executable, PROG] + list(args)
+
+def run_command(command):
+    """Run `command` to completion; return (returncode, stdout, stderr).
+
+    Where available, os.posix_spawn skips the fork() page-table copy of
+    this (potentially large) runner process.  Output goes to unlinked
+    temporary files rather than pipes, so there is no drain loop and no
+    risk of filling a pipe buffer.
+    """
+    if not hasattr(os, 'posix_spawn'):
+        p = subprocess.run(command, capture_output=True)
+        return p.returncode, p.stdout, p.stderr
+    executable = shutil.which(command[0]) or command[0]
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        file_actions = [
+                (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                (os.POSIX_SPAWN_DUP2, out.fileno(), 1),
+                (os.POSIX_SPAWN_DUP2, err.fileno(), 2),
+                ]
+        pid = os.posix_spawn(executable, command, dict(os.environ),
+                file_actions=file_actions)
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFEXITED(status):
+            returncode = os.WEXITSTATUS(status)
+        else:
+            returncode = -os.WTERMSIG(status)
+        out.seek(0)
+        err.seek(0)
+        return returncode, out.read(), err.read()
+
+def compare_output(command, out_filename):
+    returncode, output, stderr = run_command(command)
+    if returncode != 0 or stderr:
+        print("program returned %d:" % returncode)
+        print('\x1b[33m%s\x1b[m' % stderr.decode('utf-8'), end='')
         return False
+    return compare_text(output, out_filename, ' '.join(command))
 
 def test(test_name, fmt):
     out_filename = '%s.%s' % (test_name, fmt)
-    if os.path.exists(out_filename):
-        command = [sys.executable, PROG, test_name + IN_EXT, '-f', fmt,
-                '--no-rc']
-        return compare_output(command, out_filename)
+    if exists(out_filename):
+        key = cache_key(test_name, fmt)
+        if key in _result_cache:
+            return _result_cache[key]
+        command = vt100_command(test_name + IN_EXT, '-f', fmt, '--no-rc')
+        r = compare_output(command, out_filename)
+        if key is not None:
+            _result_cache[key] = r
+        return r
 
-def test_all(tests):
-    results = []
+# sys.argv/sys.stdout are process-wide, so in-process runs are serialized.
+_inprocess_lock = threading.Lock()
+
+def test_inprocess(test_name, fmt):
+    """Run one test by calling vt100.main() in this interpreter.
+
+    This skips the interpreter startup and module import that a
+    subprocess pays on every run, at the cost of not isolating the
+    parser from the runner.
+    """
+    out_filename = '%s.%s' % (test_name, fmt)
+    if not exists(out_filename):
+        return None
+    key = cache_key(test_name, fmt)
+    if key in _result_cache:
+        return _result_cache[key]
+    argv = [PROG, test_name + IN_EXT, '-f', fmt, '--no-rc']
+    with _inprocess_lock:
+        saved = sys.argv, sys.stdout, sys.stderr
+        sys.argv = argv
+        sys.stdout = io.StringIO()
+        sys.stderr = io.StringIO()
+        try:
+            try:
+                returncode = vt100.main() or 0
+            except SystemExit as e:
+                returncode = e.code or 0
+            output = sys.stdout.getvalue()
+            stderr = sys.stderr.getvalue()
+        finally:
+            sys.argv, sys.stdout, sys.stderr = saved
+    if returncode != 0 or stderr:
+        print("program returned %d:" % returncode)
+        print('\x1b[33m%s\x1b[m' % stderr, end='')
+        return False
+    r = compare_text(output.encode('utf-8'), out_filename, ' '.join(argv))
+    if key is not None:
+        _result_cache[key] = r
+    return r
+
+def _read_exact(fp, n):
+    data = b''
+    while len(data) < n:
+        chunk = fp.read(n - len(data))
+        if not chunk:
+            raise EOFError('worker closed its pipe')
+        data += chunk
+    return data
+
+class WorkerPool:
+    """A pool of long-lived ``vt100.py --server`` subprocesses.
+
+    Workers read framed requests on stdin and write framed responses on
+    stdout (see vt100.run_server), so interpreter startup is paid once
+    per worker instead of once per test.
+    """
+
+    def __init__(self, size):
+        self.procs = []
+        self.idle = queue.Queue()
+        command = vt100_command('--server', '--no-rc')
+        for i in range(size):
+            p = Popen(command, stdin=PIPE, stdout=PIPE)
+            self.procs.append(p)
+            self.idle.put(p)
+
+    def run(self, data, fmt):
+        """Parse `data` with the given format; return the output bytes."""
+        p = self.idle.get()
+        try:
+            p.stdin.write(struct.pack('>QB', len(data), FORMATS.index(fmt)))
+            p.stdin.write(data)
+            p.stdin.flush()
+            length, = struct.unpack('>Q', _read_exact(p.stdout, 8))
+            return _read_exact(p.stdout, length)
+        finally:
+            self.idle.put(p)
+
+    def close(self):
+        for p in self.procs:
+            p.stdin.close()
+            p.wait()
+
+def test_server(test_name, fmt, pool):
+    """Run one test through an idle worker from `pool`."""
+    out_filename = '%s.%s' % (test_name, fmt)
+    if not exists(out_filename):
+        return None
+    key = cache_key(test_name, fmt)
+    if key in _result_cache:
+        return _result_cache[key]
+    with open(test_name + IN_EXT, 'rb') as f:
+        data = f.read()
+    output = pool.run(data, fmt)
+    r = compare_text(output, out_filename,
+                     '%s --server < %s%s' % (PROG, test_name, IN_EXT))
+    if key is not None:
+        _result_cache[key] = r
+    return r
+
+async def _test_async(sem, test_name, fmt):
+    """Run one test under an asyncio semaphore slot."""
+    out_filename = '%s.%s' % (test_name, fmt)
+    key = cache_key(test_name, fmt)
+    if key in _result_cache:
+        return _result_cache[key]
+    command = vt100_command(test_name + IN_EXT, '-f', fmt, '--no-rc')
+    async with sem:
+        p = await asyncio.create_subprocess_exec(*command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        output, stderr = await p.communicate()
+    if p.returncode != 0 or stderr:
+        print("program returned %d:" % p.returncode)
+        print('\x1b[33m%s\x1b[m' % stderr.decode('utf-8'), end='')
+        return False
+    r = compare_text(output, out_filename, ' '.join(command))
+    if key is not None:
+        _result_cache[key] = r
+    return r
+
+def test_all_async(pairs, jobs):
+    """Supervise all test subprocesses from a single thread via asyncio.
+
+    One event loop watches every pipe, so no per-job thread stacks are
+    needed; the semaphore bounds how many children run at once.
+    """
+    async def run():
+        sem = asyncio.Semaphore(jobs or os.cpu_count())
+        return await asyncio.gather(
+                *(_test_async(sem, name, fmt) for name, fmt in pairs))
+    return asyncio.run(run())
+
+def test_batch(names, fmt):
+    """Run every test of one format through a single --batch subprocess.
+
+    This collapses one interpreter startup per test into one per format.
+    """
+    keys = dict((name, cache_key(name, fmt)) for name in names)
+    fresh = {}
+    todo = [name for name in names if keys[name] not in _result_cache]
+    if todo:
+        command = vt100_command('--batch', '-f', fmt, '--no-rc')
+        payload = bytearray()
+        for name in todo:
+            data = open(name + IN_EXT, 'rb').read()
+            payload += ('%d\n' % len(data)).encode('ascii')
+            payload += data
+        p = subprocess.run(command, input=bytes(payload), capture_output=True)
+        if p.returncode != 0 or p.stderr:
+            print("program returned %d:" % p.returncode)
+            print('\x1b[33m%s\x1b[m' % p.stderr.decode('utf-8'), end='')
+            return [(name, False) for name in names]
+        outputs = p.stdout.split(b'\x1e')
+        source = '%s < %s%s' % (' '.join(command), '%s', IN_EXT)
+        for name, out in zip(todo, outputs):
+            r = compare_text(out, '%s.%s' % (name, fmt), source % name)
+            fresh[name] = r
+            if keys[name] is not None:
+                _result_cache[keys[name]] = r
+    return [(name, _result_cache[keys[name]] if keys[name] in _result_cache
+             else fresh.get(name, False)) for name in names]
+
+def test_all(tests, jobs=None, mode='batch'):
+    names = []
     for filename in tests:
         if filename.endswith(IN_EXT):
             filename = filename[:-3]
-        for fmt in FORMATS:
-            testname = '%s.%s' % (filename, fmt)
-            r = test(filename, fmt)
-            if r is None: continue
-            results.append((testname, r))
-            msg = ' \x1b[32mOK\x1b[0m ' if r else '\x1b[31mFAIL\x1b[0m'
-            print('%-60s [%s]' % (testname, msg))
+        names.append(filename)
+
+    # The work is subprocess-bound, so threads suffice to keep every core
+    # busy.  Results are printed in submission order to keep the output
+    # deterministic regardless of completion order.
+    results = []
+    if mode == 'inprocess':
+        # Swapping sys.stdout is process-wide, so there is nothing to be
+        # gained from threads here; run on the main thread instead.
+        for name in names:
+            for fmt in FORMATS:
+                r = test_inprocess(name, fmt)
+                if r is None: continue
+                report(results, '%s.%s' % (name, fmt), r)
+        return results
+    if mode == 'asyncio':
+        pairs = [(name, fmt) for name in names for fmt in FORMATS
+                 if exists('%s.%s' % (name, fmt))]
+        for (name, fmt), r in zip(pairs, test_all_async(pairs, jobs)):
+            report(results, '%s.%s' % (name, fmt), r)
+        return results
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as ex:
+        if mode == 'batch':
+            buckets = [(fmt, [name for name in names
+                              if exists('%s.%s' % (name, fmt))])
+                       for fmt in FORMATS]
+            futures = [(fmt, ex.submit(test_batch, bucket, fmt))
+                       for fmt, bucket in buckets if bucket]
+            for fmt, future in futures:
+                for name, r in future.result():
+                    report(results, '%s.%s' % (name, fmt), r)
+        else:
+            pairs = [(name, fmt) for name in names for fmt in FORMATS
+                     if exists('%s.%s' % (name, fmt))]
+            if mode == 'server':
+                pool = WorkerPool(jobs or os.cpu_count())
+                try:
+                    futures = [ex.submit(test_server, name, fmt, pool)
+                               for name, fmt in pairs]
+                    for (name, fmt), future in zip(pairs, futures):
+                        r = future.result()
+                        if r is None: continue
+                        report(results, '%s.%s' % (name, fmt), r)
+                finally:
+                    pool.close()
+            else:
+                futures = [ex.submit(test, name, fmt) for name, fmt in pairs]
+                for (name, fmt), future in zip(pairs, futures):
+                    r = future.result()
+                    if r is None: continue
+                    report(results, '%s.%s' % (name, fmt), r)
 
     return results
 
-def main(patterns = None):
+# When stdout is not a TTY nobody is watching progress; buffer the
+# per-test lines and write them in one call at the end instead of
+# paying a flush (and, under threads, a lock) per print.
+_report_lines = None
+
+def report(results, testname, r):
+    results.append((testname, r))
+    msg = ' \x1b[32mOK\x1b[0m ' if r else '\x1b[31mFAIL\x1b[0m'
+    line = '%-60s [%s]\n' % (testname, msg)
+    if _report_lines is None:
+        sys.stdout.write(line)
+    else:
+        _report_lines.append(line)
+
+def flush_report():
+    if _report_lines:
+        sys.stdout.writelines(_report_lines)
+        del _report_lines[:]
+
+def main(argv = None):
+    parser = OptionParser(usage='%prog [OPTIONS] [PATTERN...]')
+    parser.add_option('-j', '--jobs', type='int', metavar='N',
+            help='run N tests in parallel (default: number of CPUs)')
+    parser.add_option('-m', '--mode', choices=MODES, default='inprocess',
+            help='how to invoke vt100.py: call main() in this interpreter '
+            '(inprocess, default), one --batch subprocess per format '
+            '(batch), a pool of warm --server workers (server), one '
+            'subprocess per test (spawn), or one subprocess per test '
+            'supervised by an event loop (asyncio)')
+    options, patterns = parser.parse_args(argv)
+    scan_directory()
     if not patterns:
-        tests = glob.glob('t????-*' + IN_EXT)
-        tests.sort()
+        # Match against the compiled pattern and return stems directly,
+        # saving test_all the .in strip.
+        tests = sorted(name[:-len(IN_EXT)] for name in _existing
+                       if TEST_RE.match(name))
     else:
         tests = patterns
-    r = test_all(tests)
+    global _report_lines
+    if not sys.stdout.isatty():
+        _report_lines = []
+    load_cache()
+    try:
+        r = test_all(tests, jobs=options.jobs, mode=options.mode)
+    finally:
+        flush_report()
+    save_cache()
     return int(not all(x[1] for x in r))
 
 if __name__ == "__main__":
@@ -194,6 +194,14 @@ import re
 import subprocess
 import sys
 from optparse import OptionParser, OptionGroup
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2: run uncached rather than not at all.
+    def lru_cache(maxsize=None):
+        def decorator(f):
+            return f
+        return decorator
 try:
     from ConfigParser import SafeConfigParser as ConfigParser
 except ImportError:
@@ -246,7 +254,9 @@ class TextFormatter:
     def format_line(self, line):
         """Return the given line (sequence of Characters) formatted as
         a string (without an EOL character)."""
-        return ''.join(x.char for x in line)
+        # join consumes a list faster than a generator: it can size the
+        # result in one pass instead of growing it.
+        return ''.join([x.char for x in line])
 
     def end(self):
         """Return a list of lines to be output after the formatted lines."""
@@ -298,6 +308,12 @@ class HtmlFormatter (TextFormatter):
         self.options = self.__class__.default_options.copy()
         for index, value in enumerate(self.color_256):
             self.set_color(index, value)
+        # Style strings memoized by attribute-dict identity; cells written
+        # under one attribute state share a dict, so a document has only as
+        # many distinct entries as it has style changes.  Entries keep a
+        # reference to the dict itself so an id cannot be recycled while
+        # its entry is alive.
+        self._style_cache = {}
 
     def init_colors(self):
         def create_color_table(color_scale, gray_scale):
@@ -348,7 +364,10 @@ class HtmlFormatter (TextFormatter):
     def _compute_style(self, attr):
         # TODO implement inverse
         out = []
-        if attr.pop('inverse', None):
+        if attr.get('inverse'):
+            # Work on a copy; cells may share attribute dictionaries.
+            attr = dict(attr)
+            del attr['inverse']
             fg = attr.pop('fg_color', None)
             bg = attr.pop('bg_color', None)
             if fg is not None:
@@ -384,8 +403,20 @@ class HtmlFormatter (TextFormatter):
     def format_line(self, line):
         out = []
         last_style = ''
+        style = ''
+        prev_attr = None
+        cache = self._style_cache
         for c in line:
-            style = self._compute_style(c.attr)
+            attr = c.attr
+            if attr is not prev_attr:
+                entry = cache.get(id(attr))
+                if entry is None or entry[0] is not attr:
+                    if len(cache) > 0x10000:
+                        cache.clear()
+                    entry = (attr, self._compute_style(attr))
+                    cache[id(attr)] = entry
+                style = entry[1]
+                prev_attr = attr
             if style != last_style:
                 if last_style:
                     out.append('</span>')
@@ -410,6 +441,7 @@ formatters = {
 
 class Character:
     """A single character along with an associated attribute."""
+    __slots__ = ('char', 'attr')
     def __init__(self, char, attr = {}):
         self.char = char
         self.attr = attr
@@ -421,9 +453,27 @@ class Character:
 class InvalidParameterListError (RuntimeError):
     pass
 
+@lru_cache(maxsize=512)
 def param_list(s, default, zero_is_default=True, min_length=1):
-    """Return the list of integer parameters assuming `s` is a standard
-    control sequence parameter list.  Empty elements are set to `default`."""
+    """Return the integer parameters assuming `s` is a standard control
+    sequence parameter list.  Empty elements are set to `default`.
+
+    Returns a tuple: the same few parameter strings ("", "1", "0;10", ...)
+    recur constantly, so results are memoized and must not be mutable."""
+    # Fast paths for the overwhelmingly common cases: no parameter at all,
+    # or a single integer.  Neither needs the split machinery below.
+    if not s:
+        return (default,) * max(min_length, 1)
+    if ';' not in s:
+        try:
+            value = int(s)
+        except ValueError:
+            raise InvalidParameterListError
+        if value < 0:
+            raise InvalidParameterListError
+        if zero_is_default and value == 0:
+            value = default
+        return (value,) + (default,) * (min_length - 1)
     def f(token):
         if not token:
             return default
@@ -433,34 +483,19 @@ def param_list(s, default, zero_is_default=True, min_length=1):
         if value < 0:
             raise ValueError
         return value
-    if s is None:
-        l = []
-    else:
-        try:
-            l = [f(token) for token in s.split(';')]
-        except ValueError:
-            raise InvalidParameterListError
+    try:
+        l = [f(token) for token in s.split(';')]
+    except ValueError:
+        raise InvalidParameterListError
     l += [default] * (min_length - len(l))
-    return l
-
-
-def clip(n, start, stop=None):
-    """Return n clipped to range(start,stop)."""
-    if stop is None:
-        stop = start
-        start = 0
-    if n < start:
-        return start
-    if n >= stop:
-        return stop-1
-    return n
+    return tuple(l)
 
 
 def new_sequence_decorator(dictionary):
     def decorator_generator(key):
         assert isinstance(key, (str, int))
         def decorator(f, key=key):
-            dictionary[key] = f.__name__
+            dictionary[key] = f
             return f
         return decorator
     return decorator_generator
@@ -497,9 +532,9 @@ class Screen:
             start = 0
         if stop is None or stop > self.width:
             stop = self.width
-        row = self.rows[row]
-        for c in range(start, stop):
-            row[c] = None
+        if start < stop:
+            # One C-level block store instead of a per-cell Python loop.
+            self.rows[row][start:stop] = [None] * (stop - start)
 
     def clear_rows(self, start=0, stop=None):
         """Set to None all elements on rows `start` to `stop`-1, inclusive."""
@@ -507,8 +542,10 @@ class Screen:
             start = 0
         if stop is None or stop > self.height:
             stop = self.height
-        for r in range(start, stop):
-            self.rows[r] = [None] * self.width
+        if start < stop:
+            width = self.width
+            self.rows[start:stop] = [[None] * width
+                                     for r in range(start, stop)]
 
     def shift_row(self, row, col, amount=1, fill=None):
         """Move the elements on row `row` at and to the right of column
@@ -542,6 +579,39 @@ class Terminal:
     ansi_mode = new_sequence_decorator(ansi_modes)
     dec_mode = new_sequence_decorator(dec_modes)
 
+    # ---------- State Transition Tables ----------
+
+    # For each state whose behavior depends only on the character class,
+    # a 256-entry table mapping the character to (method name, next state
+    # or None to stay).  Built once by _build_state_tables(), below; the
+    # constructor binds the names so the per-character path is two array
+    # loads and a call instead of a chain of ord() comparisons.
+
+    state_tables = {}
+
+    @classmethod
+    def _build_state_tables(cls):
+        def table(*ranges):
+            t = []
+            for stop, entry in ranges:
+                t += [entry] * (stop - len(t))
+            return t
+        cls.state_tables = {
+            'ground' : table(
+                (0x20, ('execute', None)),
+                (0x100, ('output', None))),
+            'escape' : table(
+                (0x20, ('execute', None)),
+                (0x30, ('collect', None)),
+                (0x7f, ('dispatch_escape', 'ground')),
+                (0x100, ('ignore', None))),
+            'control_sequence' : table(
+                (0x20, ('execute', None)),
+                (0x40, ('collect', None)),
+                (0x7f, ('dispatch_control_sequence', 'ground')),
+                (0x100, ('ignore', None))),
+            }
+
     # ---------- Constructor ----------
 
     def __init__(self, height=24, width=80, verbosity=False,
@@ -552,8 +622,53 @@ class Terminal:
         self.formatter = formatter
         self.main_screen = Screen(width, height)
         self.alt_screen = Screen(width, height)
+        self.bound_tables = dict(
+                (state, [(getattr(self, name), next_state)
+                         for name, next_state in entries])
+                for state, entries in self.state_tables.items())
+        self.ground_table = self.bound_tables['ground']
+        self.escape_table = self.bound_tables['escape']
+        self.control_sequence_table = self.bound_tables['control_sequence']
+        self.state_functions = dict(
+                (state, (getattr(self, 'parse_%s' % state),
+                         getattr(self, 'leave_%s' % state, None),
+                         getattr(self, 'enter_%s' % state, None)))
+                for state in ('ground', 'escape', 'control_sequence',
+                              'osc', 'dcs', 'sos', 'pm', 'apc'))
+        self.finish_functions = dict(
+                (state, getattr(self, 'finish_%s' % state, None)
+                        or self.ignore_control_string)
+                for state in self.control_string_states)
+        self.command_methods = self.bind_table(self.commands)
+        self.escape_methods = self.bind_table(self.escape_sequences)
+        # The C0 commands and escape finals are single characters, so they
+        # can go one step further than a dict: a list indexed by code.
+        self.c0_table = [self.ignore] * 0x20
+        for key, f in self.command_methods.items():
+            if len(key) == 1 and ord(key) < 0x20:
+                self.c0_table[ord(key)] = f
+        self.escape_finals = [None] * 0x80
+        for key, f in self.escape_methods.items():
+            if len(key) == 1 and ord(key) < 0x80:
+                self.escape_finals[ord(key)] = f
+        self.control_methods = self.bind_table(self.control_sequences)
+        # Same again for control sequences without a private-prefix or
+        # intermediate character, which is nearly all of them in practice.
+        self.control_finals = [None] * 0x80
+        for key, f in self.control_methods.items():
+            if len(key) == 1 and ord(key) < 0x80:
+                self.control_finals[ord(key)] = f
+        self.ansi_mode_methods = self.bind_table(self.ansi_modes)
+        self.dec_mode_methods = self.bind_table(self.dec_modes)
         self.reset()
 
+    def bind_table(self, table):
+        """Return a copy of a dispatch table with each handler replaced by
+        the corresponding bound method, so that dispatching does not create
+        a new bound method per call."""
+        return dict((key, getattr(self, f.__name__))
+                    for key, f in table.items())
+
     # ---------- Utilities ----------
 
     def reset(self):
@@ -573,7 +688,11 @@ class Terminal:
         self.previous = '\0'
         self.current = '\0'
         self.tabstops = [(i%8)==0 for i in range(self.width)]
+        self.update_tabstops()
         self.attr = {}
+        self.cell_attr = None
+        self.cell_attr_copy = None
+        self.cell_cache = {}
         self.insert_mode = False
         self.new_line_mode = False
         self.autowrap_mode = True
@@ -603,7 +722,12 @@ class Terminal:
 
     def clear(self):
         """Reset internal buffers for switching between states."""
-        self.collected = ''
+        # A list of characters, joined only when dispatched; appending to a
+        # list is amortized O(1) where growing a str is O(n) per character.
+        self.collected = []
+        # True while the last character of a control string was an
+        # unprocessed ESC, so the next character decides termination.
+        self.esc_pending = False
 
     def clip_column(self):
         """If the cursor is past the end of the line, move it to the last
@@ -611,6 +735,51 @@ class Terminal:
         if self.col >= self.width:
             self.col = self.width - 1
 
+    def update_tabstops(self):
+        """Rebuild the constant-time tab stop lookup tables.  Must be called
+        whenever self.tabstops changes.
+
+        next_tabstop[c] is the first tab stop after column `c`, or the last
+        column if there is none.  prev_tabstop[c] is the last tab stop
+        before column `c`, or column 0 if there is none; it has one extra
+        entry so that it may be indexed with the cursor just past the end of
+        the line."""
+        width = self.width
+        stops = self.tabstops
+        self.next_tabstop = nxt = [0] * width
+        last = width - 1
+        for i in range(width-1, -1, -1):
+            nxt[i] = last
+            if stops[i]:
+                last = i
+        self.prev_tabstop = prev = [0] * (width+1)
+        first = 0
+        for i in range(1, width+1):
+            if stops[i-1]:
+                first = i-1
+            prev[i] = first
+
+    def intern_character(self, c):
+        """Return a Character holding `c` and the current attributes.
+
+        Repeated characters written with the same attribute state share one
+        Character (and one attribute dict), so printing allocates in
+        proportion to the number of distinct characters rather than the
+        number printed.  This relies on cells never being modified once
+        written, which nothing does.  Attribute changes always install a new
+        self.attr dict, so a stale cache is detectable by identity."""
+        if self.attr is not self.cell_attr:
+            self.cell_attr = self.attr
+            self.cell_attr_copy = self.attr.copy()
+            self.cell_cache = {}
+        elif len(self.cell_cache) > 0x10000:
+            # Unlikely outside of pathological input, but keep it bounded.
+            self.cell_cache = {}
+        cell = self.cell_cache.get(c)
+        if cell is None:
+            cell = self.cell_cache[c] = Character(c, self.cell_attr_copy)
+        return cell
+
     def output(self, c):
         """Print the character at the current position and increment the
         cursor to the next position.  If the current position is past the end
@@ -620,10 +789,10 @@ class Terminal:
                 self.NEL()
             else:
                 self.col = self.width - 1
-        c = Character(c, self.attr.copy())
+        c = self.intern_character(c)
         if self.insert_mode:
             self.screen.shift_row(self.row, self.col)
-        self.screen[self.pos] = c
+        self.screen.rows[self.row][self.col] = c
         self.col += 1
 
     def scroll(self, n, top = None, bottom = None, save = None):
@@ -644,10 +813,14 @@ class Terminal:
         if n > 0:
             # TODO transform history?
             if (save is None and top == 0) or save:
-                self.history.extend( s.rows[top:top+n] )
+                # Trailing blanks are dead weight once a row can no longer
+                # change; trim them so a long session's history costs
+                # memory in proportion to its text.  fixup_line would have
+                # dropped them at output time anyway.
+                self.history.extend( self.drop_end(None, row)
+                                     for row in s.rows[top:top+n] )
                 if n > span:
-                    extra = n - span
-                    self.history.extend( [[None]*self.width]*extra )
+                    self.history.extend( [] for i in range(n - span) )
             if n > span:
                 n = span
             s.rows[top:bottom-n] = s.rows[top+n:bottom]
@@ -661,60 +834,153 @@ class Terminal:
 
     def ignore(self, c):
         """Ignore the character."""
-        self.debug(1, 'ignoring character: %s' % repr(c))
+        self.debug(1, 'ignoring character: %r', c)
 
     def collect(self, c):
         """Record the character as an intermediate."""
-        self.collected += c
+        self.collected.append(c)
 
     def clear_on_enter(self, old_state):
         """Since most enter_* functions just call self.clear(), this is a
         common function so that you can set enter_foo = clear_on_enter."""
         self.clear()
 
-    def debug(self, level, *args, **kwargs):
+    def debug(self, level, message, *args):
+        """Print a diagnostic to stderr.  Positional arguments are
+        %-interpolated into `message` only once the verbosity threshold
+        is met, so that callers never pay for formatting (in particular
+        repr of long payloads) when the message is suppressed."""
         if self.verbosity >= level:
-            kwargs.setdefault('file', sys.stderr)
-            print(*args, **kwargs)
+            if args:
+                message = message % args
+            print(message, file=sys.stderr)
 
     # ---------- Parsing ----------
 
+    # Matches the first character that the ground state does not simply
+    # print.  Searching with a compiled regex lets a long run of ordinary
+    # text be located in one C-level scan instead of one state-machine
+    # step per character.
+    ctrl_char_re = re.compile('[\x00-\x1f]')
+
+    # Matches the first character that a control string does not simply
+    # collect: CAN, SUB, ESC, and (for OSC) BEL.  Everything in between
+    # is payload and can be collected in bulk.
+    string_char_re = re.compile('[\x07\x18\x1a\x1b]')
+
+    # Control-string characters fall into one of four classes; the table,
+    # indexed by ord(c), replaces a chain of comparisons per character.
+    STRING_COLLECT, STRING_CANCEL, STRING_BEL, STRING_ESC = range(4)
+    string_actions = [STRING_COLLECT] * 256
+    string_actions[0x07] = STRING_BEL
+    string_actions[0x18] = STRING_CANCEL
+    string_actions[0x1a] = STRING_CANCEL
+    string_actions[0x1b] = STRING_ESC
+
+    control_string_states = ('osc', 'dcs', 'sos', 'pm', 'apc')
+
     def parse(self, s):
         """Parse an entire string."""
-        for c in s:
-            self.parse_single(c)
+        if isinstance(s, bytes):
+            # Normalize the whole input once -- latin-1 maps each byte
+            # straight to the code point of the same value, exactly what
+            # feeding the bytes through chr() one at a time used to do --
+            # so the scan below and the handlers only ever see str.
+            s = s.decode('latin1')
+        search = self.ctrl_char_re.search
+        string_search = self.string_char_re.search
+        i = 0
+        n = len(s)
+        while i < n:
+            state = self.state
+            if state == 'ground':
+                m = search(s, i)
+                j = n if m is None else m.start()
+                if j > i:
+                    self.output_run(s[i:j])
+                    i = j
+                    continue
+            elif state in self.control_string_states:
+                # Not after an unprocessed ESC, where the next character
+                # decides whether the string terminates.
+                if not self.esc_pending:
+                    m = string_search(s, i)
+                    j = n if m is None else m.start()
+                    if j > i:
+                        self.collected.extend(s[i:j])
+                        i = j
+                        continue
+            self.parse_single(s[i])
+            i += 1
+
+    def output_run(self, run):
+        """Print a run of ordinary characters, equivalent to calling
+        `output` once per character but writing each line's worth of
+        characters with a single slice assignment."""
+        if self.insert_mode:
+            for c in run:
+                self.previous, self.current = self.current, c
+                self.output(c)
+            return
+        if len(run) >= 2:
+            self.previous = run[-2]
+        else:
+            self.previous = self.current
+        self.current = run[-1]
+        intern = self.intern_character
+        while run:
+            if self.col >= self.width:
+                if self.autowrap_mode:
+                    self.NEL()
+                else:
+                    self.col = self.width - 1
+            k = min(len(run), self.width - self.col)
+            col = self.col
+            self.screen.rows[self.row][col:col+k] = [
+                    intern(c) for c in run[:k]]
+            self.col = col + k
+            run = run[k:]
 
     def parse_single(self, c):
         """Parse a single character."""
         if isinstance(c, int):
             c = chr(c)
         try:
-            f = getattr(self, 'parse_%s' % self.state)
-        except AttributeError:
+            f = self.state_functions[self.state][0]
+        except KeyError:
             raise RuntimeError("internal error: unknown state %s" %
                     repr(self.state))
         self.next_state = self.state
         f(c)
-        self.transition()
+        if self.next_state == self.state:
+            # Most characters do not change state; skip the enter/leave
+            # bookkeeping entirely rather than discovering in transition
+            # that there is nothing to do.
+            self.prev_state = self.state
+            self.next_state = None
+        else:
+            self.transition()
 
     def transition(self):
+        state_functions = self.state_functions
         if self.next_state != self.state:
-            f = getattr(self, 'leave_%s' % self.state, None)
+            f = state_functions[self.state][1]
             if f is not None:
                 f(self.next_state)
         self.next_state, self.state, self.prev_state = (None,
                 self.next_state, self.state)
         if self.state != self.prev_state:
-            f = getattr(self, 'enter_%s' % self.state, None)
+            f = state_functions[self.state][2]
             if f is not None:
                 f(self.prev_state)
 
     def parse_ground(self, c):
         self.previous, self.current = self.current, c
-        if ord(c) < 0x20:
-            self.execute(c)
-        else:
-            self.output(c)
+        code = ord(c)
+        f, next_state = self.ground_table[code if code < 0x100 else 0xff]
+        if next_state is not None:
+            self.next_state = next_state
+        f(c)
 
     # ---------- Output ----------
 
@@ -778,17 +1044,15 @@ class Terminal:
 
     def execute(self, c):
         """Execute a C0 command."""
-        name = self.commands.get(c, None)
-        f = None
-        if name is not None:
-            f = getattr(self, name, None)
-        if f is None:
-            f = self.ignore
+        code = ord(c)
+        if code >= 0x20:
+            return self.ignore(c)
+        f = self.c0_table[code]
         r = f(c)
         if r is NotImplemented:
-            self.debug(0, 'command not implemented: %s' % f.__name__)
+            self.debug(0, 'command not implemented: %s', f.__name__)
         elif r is NoNeedToImplement:
-            self.debug(1, 'ignoring command: %s' % f.__name__)
+            self.debug(1, 'ignoring command: %s', f.__name__)
 
     @command('\x00')        # ^@
     def NUL(self, c=None):
@@ -816,10 +1080,8 @@ class Terminal:
     @command('\x09')        # ^I
     def HT(self, c=None):
         """Horizontal Tab"""
-        while self.col < self.width-1:
-            self.col += 1
-            if self.tabstops[self.col]:
-                break
+        if self.col < self.width-1:
+            self.col = self.next_tabstop[self.col]
 
     @command('\x0a')        # ^J
     def LF(self, c=None):
@@ -865,29 +1127,23 @@ class Terminal:
     enter_escape = clear_on_enter
 
     def parse_escape(self, c):
-        if ord(c) < 0x20:
-            self.execute(c)
-        elif ord(c) < 0x30:
-            self.collect(c)
-        elif ord(c) < 0x7f:
-            self.next_state = 'ground'
-            self.dispatch_escape(c)
-        else:
-            self.ignore(c)
+        code = ord(c)
+        f, next_state = self.escape_table[code if code < 0x100 else 0xff]
+        if next_state is not None:
+            self.next_state = next_state
+        f(c)
 
     def dispatch_escape(self, c):
-        command = self.collected + c
-        name = self.escape_sequences.get(c, None)
-        f = None
-        if name is not None:
-            f = getattr(self, name, None)
+        command = ''.join(self.collected) + c
+        code = ord(c)
+        f = self.escape_finals[code] if code < 0x80 else None
         if f is None:
-            f = self.ignore
+            return self.ignore(command)
         r = f(command)
         if r is NotImplemented:
-            self.debug(0, 'escape not implemented: %s' % f.__name__)
+            self.debug(0, 'escape not implemented: %s', f.__name__)
         elif r is NoNeedToImplement:
-            self.debug(1, 'ignoring escape: %s' % f.__name__)
+            self.debug(1, 'ignoring escape: %s', f.__name__)
 
 
     @escape('7')
@@ -932,6 +1188,7 @@ class Terminal:
         """Horizontal Tab Set"""
         if self.col < self.width:
             self.tabstops[self.col] = True
+            self.update_tabstops()
 
     @escape('M')
     def RI(self, c=None):
@@ -988,53 +1245,60 @@ class Terminal:
     enter_control_sequence = clear_on_enter
 
     def parse_control_sequence(self, c):
-        if ord(c) < 0x20:
-            self.execute(c)
-        elif ord(c) < 0x40:
-            self.collect(c)
-        elif ord(c) < 0x7f:
-            self.next_state = 'ground'
-            self.dispatch_control_sequence(c)
-        else:
-            self.ignore(c)
+        code = ord(c)
+        f, next_state = self.control_sequence_table[code if code < 0x100
+                                                    else 0xff]
+        if next_state is not None:
+            self.next_state = next_state
+        f(c)
 
     def dispatch_control_sequence(self, c):
         self.collect(c)
-        m = re.match('^([\x30-\x3f]*)([\x20-\x2f]*[\x40-\x7f])$',
-                     self.collected)
-        if not m:
+        # Split the sequence into parameter bytes (0x30-0x3f), intermediate
+        # bytes (0x20-0x2f), and the final byte (0x40-0x7f).  A direct scan
+        # is cheaper than the regex this used to be, and the sequence is
+        # invalid exactly when anything is out of that order.
+        s = ''.join(self.collected)
+        last = len(s) - 1
+        i = 0
+        while i < last and '\x30' <= s[i] <= '\x3f':
+            i += 1
+        j = i
+        while j < last and '\x20' <= s[j] <= '\x2f':
+            j += 1
+        if j != last or not '\x40' <= s[last] <= '\x7f':
             return self.invalid_control_sequence()
-        param, command = m.groups()
+        param, command = s[:i], s[i:]
         if param and param[0] in '<=>?':
             command = param[0] + command
             param = param[1:]
 
-        name = self.control_sequences.get(command, None)
-        f = None
-        if name is not None:
-            f = getattr(self, name, None)
+        if len(command) == 1:
+            f = self.control_finals[ord(command)]
+        else:
+            f = self.control_methods.get(command)
         if f is None:
-            f = self.ignore_control_sequence
+            return self.ignore_control_sequence(command, param)
         try:
             r = f(command, param)
             if r is NotImplemented:
-                self.debug(0, 'control sequence not implemented: %s'
-                              % f.__name__)
+                self.debug(0, 'control sequence not implemented: %s',
+                              f.__name__)
             elif r is NoNeedToImplement:
-                self.debug(1, 'ignoring control sequence: %s'
-                              % f.__name__)
+                self.debug(1, 'ignoring control sequence: %s',
+                              f.__name__)
         except InvalidParameterListError:
             self.invalid_control_sequence()
 
     def invalid_control_sequence(self):
         """Called when the control sequence is invalid."""
-        self.debug(0, 'invalid control sequence: %s'
-                % (repr(self.collected)))
+        self.debug(0, 'invalid control sequence: %r',
+                ''.join(self.collected))
 
     def ignore_control_sequence(self, command, param):
         """Called when the control sequence is ignored."""
-        self.debug(1, 'ignoring control sequence: %s, %s'
-                % (repr(command), repr(param)))
+        self.debug(1, 'ignoring control sequence: %r, %r',
+                command, param)
 
 
     @control('@')
@@ -1051,33 +1315,32 @@ class Terminal:
         """Cursor Up"""
         n = param_list(param, 1)[0]
         self.clip_column()
-        if self.row >= self.margin_top:
-            self.row = clip(self.row-n, self.margin_top, self.margin_bottom+1)
-        else:
-            self.row = clip(self.row-n, self.height)
+        # Moving up can only hit the top limit, so one max suffices.
+        top = self.margin_top if self.row >= self.margin_top else 0
+        self.row = max(self.row-n, top)
 
     @control('B')
     def CUD(self, command=None, param=None):
         """Cursor Down"""
         n = param_list(param, 1)[0]
         self.clip_column()
-        if self.row <= self.margin_bottom:
-            self.row = clip(self.row+n, self.margin_top, self.margin_bottom+1)
-        else:
-            self.row = clip(self.row+n, self.height)
+        # Likewise moving down can only hit the bottom limit.
+        bottom = (self.margin_bottom if self.row <= self.margin_bottom
+                  else self.height-1)
+        self.row = min(self.row+n, bottom)
 
     @control('C')
     def CUF(self, command=None, param=None):
         """Cursor Forward"""
         n = param_list(param, 1)[0]
-        self.col = clip(self.col+n, self.width)
+        self.col = min(self.col+n, self.width-1)
 
     @control('D')
     def CUB(self, command=None, param=None):
         """Cursor Backward"""
         n = param_list(param, 1)[0]
         self.clip_column()
-        self.col = clip(self.col-n, self.width)
+        self.col = max(self.col-n, 0)
 
     @control('E')
     def CNL(self, command=None, param=None):
@@ -1095,14 +1358,14 @@ class Terminal:
     def CHA(self, command=None, param=None):
         """Character Position Absolute"""
         n = param_list(param, 1)[0]
-        self.col = clip(n-1, self.width)
+        self.col = min(n-1, self.width-1)
 
     @control('H')
     def CUP(self, command=None, param=None):
         """Cursor Position [row;column]"""
         n,m = param_list(param, 1, min_length=2)[:2]
-        self.row = clip(n-1, self.height)
-        self.col = clip(m-1, self.width)
+        self.row = min(n-1, self.height-1)
+        self.col = min(m-1, self.width-1)
 
     @control('I')
     def CHT(self, command=None, param=None):
@@ -1221,10 +1484,10 @@ class Terminal:
         """Cursor Backward Tabulation"""
         n = param_list(param, 1)[0]
         for i in range(n):
-            while self.col > 0:
-                self.col -= 1
-                if self.tabstops[self.col]:
-                    break
+            col = self.col
+            if col > self.width:
+                col = self.width
+            self.col = self.prev_tabstop[col]
 
     @control('`')
     def HPA(self, command=None, param=None):
@@ -1248,7 +1511,7 @@ class Terminal:
     def VPA(self, command=None, param=None):
         """Line Position Absolute"""
         n = param_list(param, 1)[0]
-        self.row = clip(n-1, self.height)
+        self.row = min(n-1, self.height-1)
 
     @control('e')
     def VPR(self, command=None, param=None):
@@ -1267,8 +1530,10 @@ class Terminal:
         if n == 0:
             if self.col < self.width:
                 self.tabstops[self.col] = False
+                self.update_tabstops()
         elif n == 3:
             self.tabstops[:] = [False] * self.width
+            self.update_tabstops()
 
     @control('h')
     def SM(self, command=None, param=None):
@@ -1305,9 +1570,14 @@ class Terminal:
         """Set Graphics Attributes"""
         l = param_list(param, 0)
         l_iter = iter(l)
+        # Build a new dict rather than modifying in place, so that cells
+        # already holding the old attributes are unaffected and so that a
+        # changed attribute state is detectable by identity (see
+        # intern_character).
+        attr = dict(self.attr)
         for n in l_iter:
             if n == 0:
-                self.attr.clear()
+                attr.clear()
             elif 30 <= n <= 38 or 40 <= n <= 48:
                 if n in (38, 48):
                     try:
@@ -1317,25 +1587,26 @@ class Terminal:
                         break
                     if m != 5:
                         # xterm stops parsing if this happens
-                        self.debug(0, 'invalid 256-color attribute: %s %s %s' %
-                                (m,n,o))
+                        self.debug(0, 'invalid 256-color attribute: %s %s %s',
+                                m, n, o)
                         break
                     value = o
                 else:
                     value = n % 10
                 key = 'fg_color' if n < 40 else 'bg_color'
-                self.attr[key] = value
+                attr[key] = value
             else:
                 try:
                     key, value = self.sgr_table[n]
                 except KeyError:
-                    self.debug(0, 'unknown attribute: %s' % n)
+                    self.debug(0, 'unknown attribute: %s', n)
                     pass
                 else:
                     if value is None:
-                        self.attr.pop(key, None)
+                        attr.pop(key, None)
                     else:
-                        self.attr[key] = value
+                        attr[key] = value
+        self.attr = attr
 
     sgr_table = {
             # 0 clear all attributes
@@ -1447,13 +1718,6 @@ class Terminal:
     enter_apc = clear_on_enter
     enter_pm  = clear_on_enter
 
-    # TODO OSC to set text parameters
-    def parse_osc(self, c): self.parse_control_string(c)
-    def parse_dcs(self, c): self.parse_control_string(c)
-    def parse_sos(self, c): self.parse_control_string(c)
-    def parse_pm (self, c): self.parse_control_string(c)
-    def parse_apc(self, c): self.parse_control_string(c)
-
     finish_osc = None
     finish_dcs = None
     finish_sos = None
@@ -1462,30 +1726,40 @@ class Terminal:
 
     def parse_control_string(self, c):
         # Consume the whole string and pass it to the process function.
-        if c in '\x18\x1a':
-            # CAN and SUB quit the string
-            self.cancel_control_string()
-            # should we self.execute(c) ?
-        elif c == '\x07' and self.state == 'osc':
-            # NOTE: xterm ends OSC with BEL, in addition to ESC \
-            self.finish_control_string()
-        elif self.collected and self.collected[-1] == '\x1b':
+        if self.esc_pending:
             # NOTE: xterm consumes the character after the ESC always, but
             # only process it if it is '\'.  Not sure about VTxxx.
-            self.collected = self.collected[:-1]
+            self.esc_pending = False
             if c == '\x5c':
                 self.finish_control_string()
             else:
                 self.cancel_control_string()
+            return
+        code = ord(c)
+        action = self.string_actions[code if code < 0x100 else 0xff]
+        if action == self.STRING_COLLECT:
+            self.collected.append(c)
+        elif action == self.STRING_ESC:
+            self.esc_pending = True
+        elif action == self.STRING_CANCEL:
+            # CAN and SUB quit the string
+            self.cancel_control_string()
+            # should we self.execute(c) ?
+        elif self.state == 'osc':
+            # NOTE: xterm ends OSC with BEL, in addition to ESC \
+            self.finish_control_string()
         else:
-            self.collect(c)
+            self.collected.append(c)
+
+    # TODO OSC to set text parameters
+    parse_osc = parse_control_string
+    parse_dcs = parse_control_string
+    parse_sos = parse_control_string
+    parse_pm  = parse_control_string
+    parse_apc = parse_control_string
 
     def finish_control_string(self):
-        name = 'finish_%s' % self.state
-        f = getattr(self, name, None)
-        if f is None:
-            f = self.ignore_control_string
-        f(self.collected)
+        self.finish_functions[self.state](''.join(self.collected))
         self.next_state = 'ground'
 
     def cancel_control_string(self):
@@ -1493,8 +1767,7 @@ class Terminal:
 
     def ignore_control_string(self, *args):
         """Called when a control string is ignored."""
-        self.debug(1, 'ignoring %s control string: %s' % (self.state,
-            repr(args)))
+        self.debug(1, 'ignoring %s control string: %r', self.state, args)
 
 
     # ---------- Modes ----------
@@ -1503,25 +1776,22 @@ class Terminal:
         if not param:
             return
         if mode_type == 'DEC':
-            modes = self.dec_modes
+            modes = self.dec_mode_methods
         elif mode_type == 'ANSI':
-            modes = self.ansi_modes
+            modes = self.ansi_mode_methods
         else:
-            self.debug(0, 'unknown mode type: %s' % mode_type)
+            self.debug(0, 'unknown mode type: %s', mode_type)
             return
         for n in param_list(param, 0):
-            name = modes.get(n, None)
-            f = None
-            if name is not None:
-                f = getattr(self, name, None)
+            f = modes.get(n)
             if f is None:
-                self.debug(0, 'unrecognized %s mode: %s' % (mode_type, n))
+                self.debug(0, 'unrecognized %s mode: %s', mode_type, n)
             else:
                 r = f(value)
                 if r is NotImplemented:
-                    self.debug(0, 'mode not implemented: %s' % f.__name__)
+                    self.debug(0, 'mode not implemented: %s', f.__name__)
                 if r is NoNeedToImplement:
-                    self.debug(1, 'ignoring mode: %s' % f.__name__)
+                    self.debug(1, 'ignoring mode: %s', f.__name__)
 
     @ansi_mode(4)
     def IRM(self, value):
@@ -2359,10 +2629,15 @@ class Terminal:
         return NotImplemented
 
 
+Terminal._build_state_tables()
+
+
+script_re = re.compile(r'^Script (started|done) on \w+ \d+ \w+ \d{4} '
+        r'\d\d:\d\d:\d\d \w+ \w+$')
+
+
 def remove_script_lines(text):
     """Remove the starting and ending lines produced by script(1)."""
-    script_re = re.compile(r'^Script (started|done) on \w+ \d+ \w+ \d{4} '
-            r'\d\d:\d\d:\d\d \w+ \w+$')
     try:
         first_newline = text.index(b'\n')
         first_line = text[:first_newline].decode('ascii')
@@ -2435,6 +2710,74 @@ class SimpleConfigParser (ConfigParser):
         return ConfigParser.set(self, section, *args, **kwargs)
 
 
+# Formats by frame index for --server, in a fixed order so the client
+# does not depend on dict ordering.
+server_formats = ('text', 'html')
+
+
+def run_server(options, config, rows, cols):
+    """Serve parse requests on stdin/stdout until EOF.
+
+    Each request is a 9-byte header -- a big-endian 8-byte input length
+    and a 1-byte index into `server_formats` -- followed by the input
+    itself.  Each response is a big-endian 8-byte length followed by the
+    output.  A long-lived worker like this lets a driver amortize
+    interpreter startup over an entire run.
+    """
+    import struct
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    format_cache = {}
+    while True:
+        header = stdin.read(9)
+        if len(header) < 9:
+            break
+        length, fmt_index = struct.unpack('>QB', header)
+        text = stdin.read(length)
+        try:
+            formatter = format_cache[fmt_index]
+        except KeyError:
+            formatter = formatters[server_formats[fmt_index]](config=config)
+            format_cache[fmt_index] = formatter
+        t = Terminal(verbosity=options.verbose, formatter=formatter,
+                     width=cols, height=rows)
+        if not options.non_script:
+            text = remove_script_lines(text)
+        t.parse(text)
+        out = (t.to_string() or '').encode('utf-8')
+        stdout.write(struct.pack('>Q', len(out)))
+        stdout.write(out)
+        stdout.flush()
+    return 0
+
+
+def run_batch(options, formatter, rows, cols):
+    """Parse a stream of inputs from stdin, one output per input.
+
+    Each input is preceded by a line giving its length in bytes; the
+    stream ends at EOF.  Each output is followed by an ASCII RS (0x1e)
+    character so the caller can split the concatenated results.  This
+    lets a driver (like test/run_all.py) amortize interpreter startup
+    over many small inputs.
+    """
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    while True:
+        header = stdin.readline()
+        if not header.strip():
+            break
+        text = stdin.read(int(header))
+        t = Terminal(verbosity=options.verbose, formatter=formatter,
+                     width=cols, height=rows)
+        if not options.non_script:
+            text = remove_script_lines(text)
+        t.parse(text)
+        stdout.write((t.to_string() or '').encode('utf-8'))
+        stdout.write(b'\x1e')
+        stdout.flush()
+    return 0
+
+
 def main():
 
     usage = "%prog [OPTIONS] [-f FORMAT] [-g WxH] (filename|-)"
@@ -2448,6 +2791,12 @@ def main():
             help='use W columns and H rows in output, or "detect"')
     parser.add_option('--non-script', action='store_true', default=False,
             help='do not ignore "Script (started|done) on <date>" lines')
+    parser.add_option('--batch', action='store_true', default=False,
+            help='read length-prefixed inputs from stdin and write the '
+                 'outputs separated by an ASCII RS (0x1e) character')
+    parser.add_option('--server', action='store_true', default=False,
+            help='serve framed requests on stdin/stdout until EOF '
+                 '(see run_server for the frame layout)')
     parser.add_option('--rc', metavar='FILE', default='~/.vt100rc',
             help='read configuration from FILE (default %default)')
     parser.add_option('--no-rc', action='store_true', default=False,
@@ -2492,21 +2841,12 @@ def main():
     options.verbose += config.getint(None, 'verbosity')
     del options.quiet
 
-    if len(args) != 1:
+    if options.batch or options.server:
+        if args:
+            parser.error('--batch/--server read from stdin; '
+                         'no filename allowed')
+    elif len(args) != 1:
         parser.error('missing required filename argument')
-    filename, = args
-    if filename == '-':
-        if hasattr(sys.stdin, 'buffer'):
-            # Python 3: Read in binary mode
-            text = sys.stdin.buffer.read()
-        else:
-            # Python 2: Technically we should be reading in binary mode on
-            # Windows, but that's too difficult. This works on Linux at least.
-            text = sys.stdin.read()
-    else:
-        with open(filename, 'rb') as f:
-            text = f.read()
-
     if options.format is None:
         options.format = config.get(None, 'format')
     formatter = formatters[options.format](config=config)
@@ -2521,6 +2861,25 @@ def main():
         except:
             parser.error('invalid format for --geometry: %s' % options.geometry)
 
+    if options.server:
+        return run_server(options, config, rows, cols)
+
+    if options.batch:
+        return run_batch(options, formatter, rows, cols)
+
+    filename, = args
+    if filename == '-':
+        if hasattr(sys.stdin, 'buffer'):
+            # Python 3: Read in binary mode
+            text = sys.stdin.buffer.read()
+        else:
+            # Python 2: Technically we should be reading in binary mode on
+            # Windows, but that's too difficult. This works on Linux at least.
+            text = sys.stdin.read()
+    else:
+        with open(filename, 'rb') as f:
+            text = f.read()
+
     t = Terminal(verbosity=options.verbose, formatter=formatter,
                  width=cols, height=rows)
     if not options.non_script: